@@ -1,75 +1,330 @@
-import psycopg2
-import json
-from openai import OpenAI
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import logging
+import logging.handlers
+import math
+import queue
+import re
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+import orjson
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage
+
+logger = logging.getLogger(__name__)
+
+# Shared by every instance, the tool schema and the keyword list never change
+_FORBIDDEN_COMMANDS = frozenset({
+    "DROP",
+    "DELETE",
+    "UPDATE",
+    "INSERT",
+    "CREATE",
+    "ALTER",
+    "TRUNCATE",
+    "GRANT",
+    "REVOKE",
+    "COMMIT",
+    "ROLLBACK",
+    # Read only is only the default of the session, a setting or an explicit READ WRITE transaction overrides it.
+    # END stays allowed since it closes every CASE expression, without BEGIN or START it opens nothing
+    "SET",
+    "SET_CONFIG",
+    "BEGIN",
+    "START",
+    "ABORT"
+})
+
+_TOOLS_DEFINITION = [
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_sql_query",
+            "description": "Executes an SQL query on a PostgreSQL database. At most 1000 rows are returned.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "sql_query": {
+                        "type": "string",
+                        "description": "The SQL query you wish to execute."
+                    }
+                },
+                "required": ["sql_query"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_sql_queries",
+            "description": "Executes several independent SQL queries on a PostgreSQL database in one round trip. "
+                           "Prefer it over repeated execute_sql_query calls when you already know all the queries. "
+                           "At most 1000 rows are returned per query.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "sql_queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The SQL queries you wish to execute, results come back in the same order."
+                    }
+                },
+                "required": ["sql_queries"]
+            }
+        }
+    }
+]
+
+_background_logging = None
+
+def enable_background_logging(level=logging.DEBUG, handler=None):
+    """
+    Routes this module's log records through a queue so the actual writes happen on a background thread
+    and a slow sink (a pipe, a container log driver) never blocks the event loop.
+    Calling it again replaces the previous setup instead of adding to it.
+
+    Args:
+        level (int): Log level of the module logger, DEBUG shows every executed query.
+        handler (logging.Handler): Where the records end up, stderr by default.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener, stop() it to flush and release the thread.
+    """
+    global _background_logging
+    if _background_logging is not None:
+        queue_handler, listener = _background_logging
+        listener.stop()
+        logger.removeHandler(queue_handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    listener = logging.handlers.QueueListener(records, handler or logging.StreamHandler())
+    logger.addHandler(queue_handler)
+    # Handlers of the root logger would still write synchronously on the event loop
+    logger.propagate = False
+    logger.setLevel(level)
+    listener.start()
+
+    _background_logging = (queue_handler, listener)
+    return listener
 
 class NaturalLanguageQuery:
-    def __init__(self, client: OpenAI, model: str, db_config: dict):
+    # Upper bound on the rows a single query hands back to the model
+    MAX_ROWS = 1000
+
+    # Messages at the end of the history that are always sent verbatim, older tool results get summarized
+    RECENT_MESSAGES = 12
+
+    # Cosine similarity above which a previously answered question counts as the same question
+    SIMILARITY_THRESHOLD = 0.95
+
+    # Answers kept per system prompt, the oldest ones are dropped first
+    MAX_CACHED_ANSWERS = 500
+
+    # Tool results up to this length are cheaper to keep than to summarize
+    _SUMMARY_THRESHOLD = 500
+
+    # Statements that return rows, they can be wrapped in a subquery and streamed
+    _ROWS_QUERY_RE = re.compile(r"^\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+
+    # Trailing whitespace, semicolons and comments, a -- glued to a preceding token (e.g. '--') is left alone
+    _TRAILING_RE = re.compile(r"(?:\s|;|(?:^|(?<=[\s;]))--[^\n]*|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)*\Z")
+
+    # Word boundaries keep column names like updated_at from matching, while comments like /*DROP*/ still do
+    _FORBIDDEN_RE = re.compile(rf"\b({'|'.join(sorted(_FORBIDDEN_COMMANDS))})\b", re.IGNORECASE)
+
+    # Catalog relations that only describe the schema, queries reading nothing else are answered
+    # from the schema cache once seen. Statistics views like pg_stat_activity or pg_locks change all the time
+    _SCHEMA_RELATIONS = frozenset({
+        "information_schema.tables", "information_schema.columns", "information_schema.views",
+        "information_schema.schemata", "information_schema.table_constraints", "information_schema.key_column_usage",
+        "information_schema.constraint_column_usage", "information_schema.referential_constraints",
+        "information_schema.routines", "information_schema.parameters",
+        "pg_class", "pg_attribute", "pg_constraint", "pg_namespace", "pg_index", "pg_type",
+        "pg_tables", "pg_views", "pg_indexes", "pg_proc", "pg_description"
+    })
+
+    _VOLATILE_CATALOG_RE = re.compile(r"\bpg_(stat|locks\b)", re.IGNORECASE)
+
+    # Relations listed after FROM or JOIN, comma separated ones included, with optional aliases
+    _RELATIONS_RE = re.compile(r"\b(?:FROM|JOIN)\s+((?:[\w.\"]+(?:\s+(?:AS\s+)?\w+)?\s*,\s*)*[\w.\"]+)", re.IGNORECASE)
+
+    # "Which columns does table X have" probes, keyed by (schema, table) and answered from one canonical lookup.
+    # Only plain select lists of canonical columns qualify, no DISTINCT, aliases or expressions
+    _COLUMNS_PROBE_RE = re.compile(
+        r"^SELECT (?P<columns>\w+(?: ?, ?\w+)*) FROM information_schema\.columns "
+        r"WHERE (?:table_schema ?= ?'(?P<schema>\w+)' AND )?table_name ?= ?'(?P<table>\w+)'"
+        r"(?: AND table_schema ?= ?'(?P<schema_after>\w+)')?(?: ORDER BY (?P<order>ordinal_position)(?: ASC)?)? ?;?$",
+        re.IGNORECASE
+    )
+
+    _COLUMNS_PROBE_SQL = """
+        SELECT table_schema, column_name, ordinal_position, data_type, is_nullable, column_default
+        FROM information_schema.columns
+        WHERE table_name = %(table)s AND (%(schema)s::text IS NULL OR table_schema = %(schema)s)
+        ORDER BY table_schema, ordinal_position
+    """
+
+    _COLUMNS_PROBE_COLUMNS = frozenset({
+        "table_schema", "column_name", "ordinal_position", "data_type", "is_nullable", "column_default"
+    })
+
+    # Every user table and view with its columns, keys and planner row estimate in a single round trip
+    _SCHEMA_BUNDLE_SQL = """
+        SELECT
+            n.nspname AS table_schema,
+            c.relname AS table_name,
+            c.relkind AS table_kind,
+            c.reltuples::bigint AS row_estimate,
+            a.attname AS column_name,
+            format_type(a.atttypid, a.atttypmod) AS data_type,
+            NOT a.attnotnull AS nullable,
+            EXISTS (
+                SELECT 1 FROM pg_constraint pk
+                WHERE pk.conrelid = c.oid AND pk.contype = 'p' AND a.attnum = ANY (pk.conkey)
+            ) AS primary_key,
+            (
+                SELECT fn.nspname || '.' || fc.relname || '.' || fa.attname
+                FROM pg_constraint fk
+                JOIN pg_class fc ON fc.oid = fk.confrelid
+                JOIN pg_namespace fn ON fn.oid = fc.relnamespace
+                JOIN pg_attribute fa ON fa.attrelid = fk.confrelid
+                    AND fa.attnum = fk.confkey[array_position(fk.conkey, a.attnum)]
+                WHERE fk.conrelid = c.oid AND fk.contype = 'f' AND a.attnum = ANY (fk.conkey)
+                ORDER BY fk.conname
+                LIMIT 1
+            ) AS foreign_key
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f')
+            AND NOT c.relispartition
+            AND has_table_privilege(c.oid, 'SELECT')
+            AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+            AND n.nspname NOT LIKE 'pg_toast%'
+        ORDER BY n.nspname, c.relname, a.attnum
+    """
+
+    def __init__(self, client: AsyncOpenAI, model: str, db_config: dict, response_cache=None, embedding_model=None,
+                 answer_cache=None, verbose=True):
         self.client = client
         self.model = model
         self.db_config = db_config
 
-        self.tools_definition = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "execute_sql_query",
-                    "description": "Executes an SQL query on a PostgreSQL database.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "sql_query": {
-                                "type": "string",
-                                "description": "The SQL query you wish to execute."
-                            }
-                        },
-                        "required": ["sql_query"]
-                    }
-                }
-            }
-        ]
+        # Whether the model's replies are printed as they arrive, queries go to the module logger instead
+        self.verbose = verbose
+
+        # Answers to earlier questions are reused for paraphrases of them when an embedding model is given,
+        # e.g. "text-embedding-3-small", otherwise only for questions that normalize to the same text.
+        # Only opening questions are cached, keyed on the system prompt they were asked against, so a follow-up
+        # like "and by month?" is never answered from another context. Pass a shared dict-like object
+        # (e.g. diskcache.Cache) to reuse answers across sessions
+        self.embedding_model = embedding_model
+        self.answer_cache = {} if answer_cache is None else answer_cache
+
+        # Maps a hash of the request to the assistant message it produced,
+        # pass a shared dict-like object (e.g. diskcache.Cache) to reuse responses across sessions
+        self.response_cache = {} if response_cache is None else response_cache
+
+        # Connections are opened lazily on the first query, since opening needs a running event loop,
+        # and live as long as the pool so prepared statements survive between queries.
+        # Autocommit saves the COMMIT round trip of read only queries. Read only is only a session default
+        # and the keyword check is a best effort, neither is a guarantee,
+        # only a role that has nothing but SELECT privileges prevents writes for sure
+        # Options the caller passed, e.g. "-c search_path=...", are kept
+        options = " ".join(filter(None, [db_config.get("options"), "-c default_transaction_read_only=on"]))
+        self.pool = AsyncConnectionPool(
+            kwargs={**db_config, "autocommit": True, "options": options},
+            min_size=1,
+            max_size=10,
+            open=False,
+            reset=self._reset_connection
+        )
+
+        self.tools_definition = _TOOLS_DEFINITION
 
         self.tools_map = {
-            "execute_sql_query": self._execute_sql_query
+            "execute_sql_query": self._execute_sql_query,
+            "execute_sql_queries": self._execute_sql_queries
         }
 
-        self.forbidden_commands = [
-            "DROP",
-            "DELETE",
-            "UPDATE",
-            "INSERT",
-            "CREATE",
-            "ALTER",
-            "TRUNCATE",
-            "GRANT",
-            "REVOKE",
-            "COMMIT",
-            "ROLLBACK"
-        ]
-
         self.messages = []
 
-        self._initialize_ai()
+        self._schema_cache = {}
+
+        # Messages before this index have already been compacted
+        self._compacted_until = 0
+
+    @staticmethod
+    async def _reset_connection(conn):
+        # Settings the model changed with SET must not leak into later queries that get the same connection,
+        # RESET ALL goes back to the startup options and leaves prepared statements alone
+        await conn.execute("RESET ALL")
+
+    async def _initialize_ai(self):
+        await self.pool.open()
+
+        # The system message is the prefix of every request, it has to stay byte-identical between
+        # calls for the provider's prompt caching to kick in, hence the fixed row order of the bundle
+        schema = self._format_schema(await self._fetch(self._SCHEMA_BUNDLE_SQL))
 
-    def _initialize_ai(self):
         system_prompt = {
             "role": "system",
             "content": """You are an assistant who answers questions about a postgres database that you can access.
                     You can execute any SELECT query using execute_sql_query tool.
-                    If you don't have enough information you can query schema information and sample data from tables.
-                    Don't speculate and don't assume anything about the schema, read actual schema before referencing any tables or columns.
+                    The schema of the database is listed below, one table per line with its approximate row count
+                    and columns, PK marks primary key columns and -> points to the column a foreign key references.
+                    If you don't have enough information you can query additional schema information and sample data from tables.
+                    Don't speculate and don't assume anything about the schema, only reference tables and columns that actually exist.
                     Don't ask for clarification from the user, this is not an interactive chat, explore database until you can provide a human readable answer.
-                        """
+
+                    """ + schema
         }
-        
+
         self.messages.append(system_prompt)
 
-        schema = self._execute_sql_query("SELECT table_schema, table_name FROM information_schema.tables")
-        self.messages.append({
-            "role": "user",
-            "content": schema
-        })
+    @classmethod
+    def _format_schema(cls, rows):
+        """
+        Renders the schema bundle as compact text, e.g.
+        public.orders (100+ rows): order_id smallint PK, customer_id character varying -> public.customers.customer_id
+        """
+        kinds = {"v": "view", "m": "materialized view", "f": "foreign table"}
+        lines = []
+        for (schema, table), columns in itertools.groupby(rows, key=lambda r: (r["table_schema"], r["table_name"])):
+            columns = list(columns)
+            first = columns[0]
+            details = [cls._format_row_estimate(first["row_estimate"])]
+            if first["table_kind"] in kinds:
+                details.append(kinds[first["table_kind"]])
 
-    def _execute_sql_query(self, sql_query):
+            described = []
+            for column in columns:
+                text = f"{column['column_name']} {column['data_type']}"
+                if column["primary_key"]:
+                    text += " PK"
+                elif column["nullable"]:
+                    text += " NULL"
+                if column["foreign_key"]:
+                    text += f" -> {column['foreign_key']}"
+                described.append(text)
+
+            lines.append(f"{schema}.{table} ({', '.join(details)}): {', '.join(described)}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format_row_estimate(row_estimate):
+        # The exact estimate moves with every autovacuum or ANALYZE, only its order of magnitude goes into
+        # the system message so the prompt stays byte-stable. reltuples is -1 until the table has been analyzed
+        if row_estimate < 0:
+            return "row count unknown"
+        if row_estimate < 10:
+            return "under 10 rows"
+        return f"{10 ** (len(str(row_estimate)) - 1)}+ rows"
+
+    async def _execute_sql_query(self, sql_query):
         """
         Executes an arbitrary SQL query on a PostgreSQL database.
         
@@ -79,84 +334,325 @@ class NaturalLanguageQuery:
         Returns:
             str: A JSON string representing the results or an error message.
         """
-        print(f"Executing query: {sql_query}")
+        logger.debug("Executing query: %s", sql_query)
        
         try:
-            for cmd in self.forbidden_commands:
-                if cmd in sql_query.upper():
-                    return json.dumps({"error": "You are not allowed to execute this command."})
-
-            conn = psycopg2.connect(**self.db_config)
-            cur = conn.cursor()
-            cur.execute(sql_query)
-            
-            # If the query returns rows, fetch them
-            if cur.description:
-                columns = [desc[0] for desc in cur.description]
-                rows = cur.fetchall()
-                results = [dict(zip(columns, row)) for row in rows]
-            else:
-                results = {"message": "Query executed successfully."}
-            conn.commit()
-            return json.dumps(results)
+            if self._FORBIDDEN_RE.search(sql_query):
+                return self._dumps({"error": "You are not allowed to execute this command."})
+
+            # Collapse whitespace so formatting differences hit the same cache entry
+            normalized = " ".join(sql_query.split())
+
+            probe = self._COLUMNS_PROBE_RE.match(normalized)
+            columns = [column.strip().lower() for column in probe["columns"].split(",")] if probe else []
+            if probe and set(columns) <= self._COLUMNS_PROBE_COLUMNS:
+                schema = probe["schema"] or probe["schema_after"]
+                key = (schema, probe["table"])
+                if key not in self._schema_cache:
+                    self._schema_cache[key] = await self._fetch(
+                        self._COLUMNS_PROBE_SQL, {"schema": schema, "table": probe["table"]}, prepare=True
+                    )
+                rows = self._schema_cache[key]
+                if probe["order"]:
+                    rows = sorted(rows, key=lambda row: row["ordinal_position"])
+                # Answer with exactly the columns that were asked for
+                return self._dumps([{column: row[column] for column in columns} for row in rows])
+
+            if self._is_schema_query(normalized):
+                if normalized not in self._schema_cache:
+                    self._schema_cache[normalized] = self._dumps(await self._fetch(sql_query))
+                return self._schema_cache[normalized]
+
+            return self._dumps(await self._fetch(sql_query))
         except Exception as e:
-            return json.dumps({"error": str(e)})
-        finally:
-            if 'cur' in locals():
-                cur.close()
-            if 'conn' in locals():
-                conn.close()
-
-    def run_query(self, query: str):
-        
+            return self._dumps({"error": str(e)})
+
+    def _is_schema_query(self, sql_query):
+        if self._VOLATILE_CATALOG_RE.search(sql_query):
+            return False
+        relations = [
+            relation.split()[0].replace('"', "").lower().removeprefix("pg_catalog.")
+            for relations in self._RELATIONS_RE.findall(sql_query)
+            for relation in relations.split(",")
+        ]
+        return bool(relations) and all(relation in self._SCHEMA_RELATIONS for relation in relations)
+
+    async def _execute_sql_queries(self, sql_queries):
+        """
+        Executes several SQL queries on a PostgreSQL database in a single round trip using pipeline mode.
+
+        Args:
+            sql_queries (list[str]): The SQL queries to execute.
+
+        Returns:
+            str: A JSON string with a list of results or error messages, one per query in the given order.
+        """
+        results = [None] * len(sql_queries)
+        pipelined = []
+        for i, sql_query in enumerate(sql_queries):
+            logger.debug("Executing query: %s", sql_query)
+            if self._FORBIDDEN_RE.search(sql_query):
+                results[i] = {"error": "You are not allowed to execute this command."}
+            else:
+                pipelined.append(i)
+
+        try:
+            async with self.pool.connection() as conn:
+                # All queries are sent before any result is awaited, the block exit syncs the pipeline
+                async with conn.pipeline():
+                    cursors = [conn.cursor(row_factory=dict_row) for _ in pipelined]
+                    for i, cur in zip(pipelined, cursors):
+                        await cur.execute(self._limit_rows(sql_queries[i]))
+
+                for i, cur in zip(pipelined, cursors):
+                    # _limit_rows leaves some queries unwrapped, the fetch enforces the cap for all of them
+                    results[i] = await cur.fetchmany(self.MAX_ROWS) if cur.description else {"message": "Query executed successfully."}
+                    await cur.close()
+        except Exception:
+            # A failing query aborts the rest of the pipeline, rerun them separately to report each outcome
+            outcomes = await asyncio.gather(*(self._execute_sql_query(sql_query) for sql_query in sql_queries))
+            return "[" + ",".join(outcomes) + "]"
+
+        return self._dumps(results)
+
+    def _limit_rows(self, sql_query):
+        # Pipelined queries run on plain cursors, the cap has to be part of the SQL itself
+        stripped = self._TRAILING_RE.sub("", sql_query, count=1)
+        if not self._ROWS_QUERY_RE.match(stripped) or ";" in stripped:
+            return sql_query
+        return f"SELECT * FROM ({stripped}) _sub LIMIT {self.MAX_ROWS}"
+
+    @staticmethod
+    def _dumps(obj, option=None):
+        # orjson handles datetime and UUID natively, Decimal and other leftovers fall back to str
+        return orjson.dumps(obj, default=str, option=option).decode()
+
+    async def _fetch(self, sql_query, params=None, prepare=False):
+        async with self.pool.connection() as conn:
+            if prepare:
+                # Canonical probes have bounded results, a plain cursor lets them reuse a prepared statement
+                # of the connection instead of being parsed and planned again
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(sql_query, params, prepare=True)
+                    return await cur.fetchall()
+
+            # Streaming takes a single statement only
+            if self._ROWS_QUERY_RE.match(sql_query) and ";" not in self._TRAILING_RE.sub("", sql_query, count=1):
+                # Rows are streamed straight into dicts in one round trip, with autocommit there is no BEGIN or
+                # COMMIT around it. Reading stops at MAX_ROWS, closing the stream early cancels the rest of the query
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    rows = []
+                    async with contextlib.aclosing(cur.stream(sql_query, params)) as stream:
+                        async for row in stream:
+                            rows.append(row)
+                            if len(rows) == self.MAX_ROWS:
+                                break
+                    return rows
+
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(sql_query, params)
+
+                # Of several statements the last one is reported
+                while cur.nextset():
+                    pass
+
+                # If the query returns rows, fetch them
+                if cur.description:
+                    return await cur.fetchmany(self.MAX_ROWS)
+                return {"message": "Query executed successfully."}
+
+    def clear_schema_cache(self):
+        """
+        Forgets cached schema lookups, call it after the database schema has changed.
+        """
+        self._schema_cache.clear()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _complete(self):
+        # Everything that shapes the response is part of the key, a persistent cache must not replay
+        # responses recorded against a different tool set
+        request = {
+            "model": self.model,
+            "temperature": 0,
+            "messages": self.messages,
+            "tools": self.tools_definition,
+            "tool_choice": "auto",
+        }
+        key = hashlib.blake2b(
+            orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+        ).hexdigest()
+
+        if key in self.response_cache:
+            message = ChatCompletionMessage.model_validate(self.response_cache[key])
+            if self.verbose and message.content:
+                print(message.content)
+            return message
+
+        stream = await self.client.chat.completions.create(**request, stream=True)
+
+        # Content is printed as it arrives, tool calls come in fragments that are stitched back together by index
+        content = []
+        tool_calls = {}
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+
+            if delta.content:
+                if self.verbose:
+                    print(delta.content, end="", flush=True)
+                content.append(delta.content)
+
+            for fragment in delta.tool_calls or []:
+                tool_call = tool_calls.setdefault(
+                    fragment.index, {"id": None, "type": "function", "function": {"name": "", "arguments": ""}}
+                )
+                if fragment.id:
+                    tool_call["id"] = fragment.id
+                if fragment.function and fragment.function.name:
+                    tool_call["function"]["name"] += fragment.function.name
+                if fragment.function and fragment.function.arguments:
+                    tool_call["function"]["arguments"] += fragment.function.arguments
+
+        if self.verbose and content:
+            print()
+
+        message = ChatCompletionMessage.model_validate({
+            "role": "assistant",
+            "content": "".join(content) or None,
+            "tool_calls": [tool_calls[index] for index in sorted(tool_calls)] or None,
+        })
+        self.response_cache[key] = message.model_dump()
+        return message
+
+    def _compact_messages(self):
+        """
+        Replaces large tool results that fell out of the recent window with a one-line summary,
+        so the cost of every request stays flat instead of growing with the length of the session.
+        """
+        end = len(self.messages) - self.RECENT_MESSAGES
+        if end <= self._compacted_until:
+            return
+
+        # Tool results follow the assistant message that requested them, so calls are resolved
+        # against the latest assistant message only
+        calls = {}
+        for i, message in enumerate(self.messages[:end]):
+            if message["role"] == "assistant":
+                calls = {tool_call["id"]: tool_call["function"] for tool_call in message.get("tool_calls", [])}
+            elif i >= self._compacted_until and message["role"] == "tool" and len(message["content"]) > self._SUMMARY_THRESHOLD:
+                function = calls[message["tool_call_id"]]
+                # A batch of queries can be as long as the result it summarizes
+                arguments = self._truncate(function["arguments"])
+                self.messages[i] = {
+                    **message,
+                    "content": f"Summary of an earlier {function['name']} call with {arguments}: "
+                               + self._summarize_result(message["content"])
+                }
+        self._compacted_until = end
+
+    @staticmethod
+    def _truncate(text, limit=200):
+        return text if len(text) <= limit else text[:limit] + "..."
+
+    @classmethod
+    def _summarize_result(cls, content):
+        result = orjson.loads(content)
+        if isinstance(result, list) and result and all(isinstance(row, dict) for row in result):
+            # A single wide text or JSON column would otherwise keep the summary as large as the result
+            first_row = cls._truncate(orjson.dumps(result[0]).decode())
+            return f"{len(result)} rows with columns {', '.join(result[0])}, first row {first_row}"
+        return cls._truncate(content)
+
+    @staticmethod
+    def _normalize_query(query):
+        # "What was Q1 revenue?" and "what was q1 revenue" share a cache entry, operators like < or - are kept
+        # since "orders > 100" and "orders < 100" are different questions
+        return re.sub(r"[?.!\s]+$", "", " ".join(query.lower().split()))
+
+    async def _embed(self, query):
+        response = await self.client.embeddings.create(model=self.embedding_model, input=query)
+        embedding = response.data[0].embedding
+        # Unit length turns cosine similarity into a plain dot product
+        norm = math.sqrt(sum(x * x for x in embedding))
+        return [x / norm for x in embedding]
+
+    def _find_similar_answer(self, embedding, answer_embeddings):
+        best_answer, best_similarity = None, self.SIMILARITY_THRESHOLD
+        for cached_embedding, answer in answer_embeddings:
+            similarity = sum(a * b for a, b in zip(embedding, cached_embedding))
+            if similarity > best_similarity:
+                best_answer, best_similarity = answer, similarity
+        return best_answer
+
+    async def run_query(self, query: str):
+        if not self.messages:
+            await self._initialize_ai()
+
+        # Later questions depend on the whole conversation before them, which never repeats,
+        # so only the opening question is looked up and stored, under the system prompt
+        opening = len(self.messages) == 1
+        answer, embedding = None, None
+        if opening:
+            prompt_key = hashlib.blake2b(self.messages[0]["content"].encode()).hexdigest()
+            answers = self.answer_cache.get(prompt_key, {"answers": {}, "embeddings": []})
+            normalized = self._normalize_query(query)
+            answer = answers["answers"].get(normalized)
+            if answer is None and self.embedding_model:
+                embedding = await self._embed(query)
+                answer = self._find_similar_answer(embedding, answers["embeddings"])
+
+        if answer is not None:
+            # The question was answered before, skip the whole exploration but keep the history coherent
+            if self.verbose:
+                print(answer)
+            self.messages.append({"role": "user", "content": query})
+            self.messages.append({"role": "assistant", "content": answer})
+            return answer
+
         self.messages.append({
             "role": "user",
             "content": query
         })
 
-        # First iteration: Force tool usage to start database exploration
-        force_tool = True
-
+        # No tool call is forced on the first turn, the exploration it used to kick off is already
+        # done by the schema bundle in the system message, so the model may answer or query right away
         while True:
-            # Use different tool_choice strategy based on iteration
-            tool_choice_param = {"type": "function", "function": {"name": "execute_sql_query"}} if force_tool else "auto"
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                temperature=0,
-                messages=self.messages,
-                tools=self.tools_definition,
-                tool_choice=tool_choice_param,
-            )
-
-            message = response.choices[0].message
-
-            if message.content:
-                print(message.content)
-                
-            self.messages.append(message)
-
-            # After first iteration, let the model decide whether to use tools
-            force_tool = False
+            message = await self._complete()
+            # Unset fields like refusal or audio are dropped, the API has no use for them in the history
+            self.messages.append(message.model_dump(exclude_none=True))
 
             if message.tool_calls:
-                for tool_call in message.tool_calls:
-                    # Get the tool function name and arguments Grok wants to call
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-
-                    # Call one of the tool function defined earlier with arguments
-                    result = self.tools_map[function_name](**function_args)
+                # Run all tool calls of this turn concurrently, gather keeps their order
+                results = await asyncio.gather(*(
+                    # Call one of the tool function defined earlier with arguments Grok wants to call
+                    self.tools_map[tool_call.function.name](**orjson.loads(tool_call.function.arguments))
+                    for tool_call in message.tool_calls
+                ))
 
+                for tool_call, result in zip(message.tool_calls, results):
                     # Append the result from tool function call to the chat message history,
                     # with "role": "tool"
                     self.messages.append(
                         {
                             "role": "tool",
-                            "content": json.dumps(result),
+                            "content": result,  # already a JSON string
                             "tool_call_id": tool_call.id  # tool_call.id supplied in Grok's response
                         }
                     )
+
+                self._compact_messages()
             else:
                 # If no tool calls, we have our final answer
+                if opening:
+                    answers["answers"][normalized] = message.content
+                    if len(answers["answers"]) > self.MAX_CACHED_ANSWERS:
+                        del answers["answers"][next(iter(answers["answers"]))]
+                    if embedding is not None:
+                        answers["embeddings"].append((embedding, message.content))
+                        del answers["embeddings"][:-self.MAX_CACHED_ANSWERS]
+                    # Stored back explicitly so persistent caches like diskcache.Cache see the update
+                    self.answer_cache[prompt_key] = answers
                 return message.content